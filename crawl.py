@@ -3,16 +3,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 import os
+import re
 import sys
 import time
 import json
-import uuid
 import errno
 import logging
 import argparse
-import urlparse
+import binascii
+import threading
 import subprocess
-import ConfigParser
+import collections
+import concurrent.futures
+try:
+  import urllib.parse as urlparse
+except ImportError:
+  import urlparse
 import requests
 import warc
 import warc_simple
@@ -20,8 +26,21 @@ import retweever
 import tweet_tools
 
 KEY_NAMES = ('consumer_key', 'consumer_secret', 'access_token_key', 'access_token_secret')
-ARG_DEFAULTS = {'format':'human', 'output':sys.stdout, 'limit':sys.maxsize, 'log':sys.stderr,
-                'volume':logging.WARNING}
+HOST_REGEX = re.compile(r'^https?://([^/]+)')
+# Guards count updates in the shared dedup dict when --threads fetches concurrently.
+DONE_LOCK = threading.Lock()
+# A profile entry is one whose WARC record points at the users/lookup endpoint. Searching for
+# the whole header line in the raw block is equivalent to parsing the headers and checking the
+# value's prefix, without the per-entry dict build.
+PROFILE_MARKER = 'WARC-Refers-To-Target-URI: https://api.twitter.com/1.1/users/lookup.json'
+ARG_DEFAULTS = {'format':'human', 'output':sys.stdout, 'limit':sys.maxsize, 'threads':1,
+                'log':sys.stderr, 'volume':logging.WARNING}
+
+# Everything from an entry that's needed to write its conversation once the fetch finishes.
+# in_reply_to_id comes from the extract_tweet() dict, so it's already nulled for profiles.
+EntryContext = collections.namedtuple('EntryContext',
+                                      ('use_original', 'in_reply_to_id', 'headers', 'entry',
+                                       'warcinfo_id', 'file_num', 'entry_num'))
 DESCRIPTION = """This script will read a series of tweets from unzipped WARC files, then use the
 Twitter API to re-retrieve them (to get the full, un-truncated text) and gather replies and other
 information related to them."""
@@ -60,7 +79,12 @@ def main(argv):
     help='Value for this field in the warcinfo record. If not given, this will try to determine '
          'your IP automatically.')
   parser.add_argument('-L', '--limit', type=int,
-    help='Maximum number of tweets to request from the Twitter API.')
+    help='Maximum number of tweets to request from the Twitter API. When --threads is more than '
+         '1, this is approximate, since requests can be in flight when the limit is hit.')
+  parser.add_argument('-t', '--threads', type=int,
+    help='Number of threads to use for Twitter API requests. Different entries\' conversations '
+         'are independent, so with more than 1 thread their network latency is overlapped. '
+         'Output is still written in the input order. Default: %(default)s')
   parser.add_argument('-c', '--consumer-key')
   parser.add_argument('-C', '--consumer-secret')
   parser.add_argument('-a', '--access-token-key')
@@ -93,8 +117,22 @@ def main(argv):
   # The output filename, if present, should be put in the warcinfo record.
   if args.output is sys.stdout:
     outfile = None
+    # stdout deserves the same big buffer as a file: when it's a terminal it's line-buffered,
+    # which means a syscall per write. Wrap a dup of the fd so sys.stdout itself is untouched.
+    args.output = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 8*1024*1024)
   else:
     outfile = os.path.basename(args.output.name)
+  if outfile and not args.output.name.startswith('<'):
+    # Re-open the output with a big buffer. The output is a stream of many small writes, and the
+    # default 8 KiB buffer means a syscall every few records.
+    args.output.close()
+    args.output = open(args.output.name, 'w', 8*1024*1024)
+
+  # These never change within one run, so look them up once here instead of per input file in
+  # create_warcinfo() (a subprocess spawn and a network round-trip, respectively).
+  if args.format == 'warc':
+    git_commit = get_git_commit()
+    ip = args.ip or get_public_ip()
 
   done = {}
   rate_limit = -1
@@ -102,123 +140,219 @@ def main(argv):
   empties = 0
   file_num = 0
   entry_num = 0
+  warcinfo_id = None
+  pool = None
+  pending = collections.deque()
+  if args.threads > 1 and not args.parse_tweets:
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.threads)
+  # Pre-bind the per-entry lookups to locals: a LOAD_FAST per use instead of attribute/dict
+  # lookups, which compounds over millions of entries.
+  out_write = args.output.write
+  out_writelines = args.output.writelines
+  parse_entry = tweet_tools.parse_entry
+  extract_fields = tweet_tools.extract_fields
+  extract_tweet = tweet_tools.extract_tweet
+  format_tweet_for_humans = tweet_tools.format_tweet_for_humans
+  fmt_human = args.format == 'human'
+  fmt_warc = args.format == 'warc'
+  warc_passthrough = args.parse_tweets and fmt_warc
   for warc_path in args.warcs:
     file_num += 1
     logging.info('Starting file {}: {}'.format(file_num, warc_path))
     # Create the warcinfo WARC record for this file.
-    if args.format == 'warc':
+    if fmt_warc:
       warc_name = os.path.basename(warc_path)
-      warcinfo = create_warcinfo(infile=warc_name, outfile=outfile, ip=args.ip,
-                                 operator=args.operator, description=args.description)
+      warcinfo = create_warcinfo(infile=warc_name, outfile=outfile, ip=ip,
+                                 operator=args.operator, description=args.description,
+                                 git_commit=git_commit)
       warcinfo_id = warcinfo.header.record_id
       warcinfo.write_to(args.output)
       args.output.write('\r\n')
-    for entry, headers in warc_simple.parse(warc_path, payload_json=False, header_dict=False):
+    # iter_payloads() only reads as far as we consume it, so breaking out on --limit below never
+    # pays to parse the rest of the file. Keep a handle on the generator so the break can also
+    # close the underlying file right away instead of waiting for garbage collection.
+    payloads = warc_simple.iter_payloads(warc_path)
+    for headers, entry in payloads:
       entry_num += 1
-      tweet = tweet_tools.extract_tweet(entry)
-      headers_dict = warc_simple.headers_to_dict(headers)
-      target_uri = headers_dict.get('WARC-Refers-To-Target-URI')
-      is_profile = target_uri and target_uri.startswith('https://api.twitter.com/1.1/users/lookup.json')
-      if tweet:
+      # Quick rejection before the JSON parse: an entry only counts as non-empty if it contains
+      # a user or status object, and a JSON key always appears quoted. A false hit (e.g. the
+      # word in a tweet's text) just means we parse and find the entry empty the normal way.
+      if '"user"' in entry or '"status"' in entry:
+        entry_dict = parse_entry(entry)
+        fields = extract_fields(entry_dict)
+      else:
+        fields = None
+      is_profile = PROFILE_MARKER in headers
+      if fields is None:
+        tweet = None
+      elif warc_passthrough:
+        # The warc passthrough re-emits the original record, and the only tweet data it needs
+        # is the reply info for the X-Tweet headers -- which extract_fields() already pulled.
+        # Skip the full extract_tweet() dict build. Profiles get None reply fields the same way
+        # extract_tweet() nulls them: the reply data belongs to the attached status, not the
+        # profile the record is about.
+        if 'status' in entry_dict and 'screen_name' in entry_dict:
+          tweet = {'in_reply_to_id':None, 'in_reply_to_user':None}
+        else:
+          tweet = {'in_reply_to_id':fields.in_reply_to_id,
+                   'in_reply_to_user':fields.in_reply_to_user}
+      else:
+        tweet = extract_tweet(entry_dict, datatype='json')
         tweet['is_profile'] = is_profile
       if not tweet:
         # Empty entry.
         empties += 1
-        if args.format == 'human':
-          args.output.write('{}/{}: Empty entry.\n\n'.format(file_num, entry_num))
-        elif args.format == 'warc':
-          # Print it literally and move on.
-          args.output.write(warc_header_fix(headers, headers_dict, warcinfo_id)+'\r\n')
-          args.output.write(entry+'\r\n')
+        if fmt_human:
+          out_write('{}/{}: Empty entry.\n\n'.format(file_num, entry_num))
+        elif fmt_warc:
+          # Print it literally and move on. There are no tweet headers to add, so skip the
+          # header-dict parse and append the ids straight onto the raw block.
+          out_writelines((warc_header_fix_empty(headers, warcinfo_id), '\r\n',
+                          entry, '\r\n'))
       elif args.parse_tweets:
         # Don't make any Twitter API requests. Just print what you see, with some fixes.
         tweet_data = {'tweet':tweet}
-        if args.format == 'human':
-          args.output.write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num)+'\n')
-        elif args.format == 'warc':
-          args.output.write(warc_header_fix(headers, headers_dict, warcinfo_id, tweet_data)+'\r\n')
-          args.output.write(entry+'\r\n')
+        if fmt_human:
+          out_write(format_tweet_for_humans(tweet_data, file_num, entry_num)+'\n')
+        elif fmt_warc:
+          out_writelines((warc_header_fix(headers, warcinfo_id, tweet_data),
+                          '\r\n', entry, '\r\n'))
       else:
         # Print this tweet and all others above it in the conversation.
         looks_truncated = tweet_tools.does_tweet_look_truncated(tweet)
         # Determine whether to skip re-retrieving the first tweet.
         # If it's a profile, or if it didn't get truncated, we can use the original.
         use_original = is_profile or not looks_truncated
-        logging.info('{}/{}: is_profile: {}, looks_truncated: {}, use_original: {}'
-                     .format(file_num, entry_num, is_profile, looks_truncated, use_original))
+        logging.info('%s/%s: is_profile: %s, looks_truncated: %s, use_original: %s',
+                     file_num, entry_num, is_profile, looks_truncated, use_original)
         # Retrieve all tweets in the conversation.
         remaining = args.limit - api_requests
         if args.dedup:
-          try:
-            conversation = get_conversation(tweet, api, use_original, remaining, done)
-          except AttributeError:
-            logging.warn('{}/{}: {}'.format(file_num, entry_num, tweet))
-            raise
+          dedup_done = done
         else:
-          conversation = get_conversation(tweet, api, use_original, remaining)
-        api_requests += len(conversation)
-        if use_original:
-          api_requests -= 1
-        rate_limit = summarize_rate_limit_status(api, rate_limit, file_num, entry_num)
-        if tweet['in_reply_to_id']:
-          logging.info('{}/{}: Reply tweet; retrieved {} in conversation chain.'
-                       .format(file_num, entry_num, len(conversation)))
-        elif len(conversation) == 0:
-          logging.warn('{}/{}: No tweets in conversation.'.format(file_num, entry_num))
-        # Print out the conversation.
-        first_tweet = True
-        for tweet_data in conversation:
-          response = tweet_data['response']
-          api_error = get_api_error(response)
-          if use_original:
-            # We didn't need to re-retrieve the tweet. Just print the original.
-            if args.format == 'human':
-              args.output.write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num))
-            elif args.format == 'warc':
-              new_headers = warc_header_fix(headers, headers_dict, warcinfo_id, tweet_data)
-              args.output.write(new_headers+'\r\n')
-              args.output.write(entry+'\r\n')
-          elif response.status_code == 200:
-            if args.format == 'human':
-              args.output.write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num))
-            elif args.format == 'warc':
-              write_warcs(tweet_data, args.output, warcinfo_id)
-          elif first_tweet:
-            # It's the first tweet in the conversation, but it's truncated, and retrieval from
-            # the Twitter API failed. Use the original data from the input WARC instead.
-            if args.format == 'human':
-              args.output.write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num))
-            elif args.format == 'warc':
-              logging.warn('{}/{}: {} on old tweet. Using original data instead.'
-                           .format(file_num, entry_num, api_error))
-              new_headers = warc_header_fix(headers, headers_dict, warcinfo_id, tweet_data)
-              args.output.write(new_headers+'\r\n')
-              args.output.write(entry+'\r\n')
-          else:
-            # It's an earlier tweet in the conversation, but retrieval from the Twitter API
-            # failed. All we can do is print the error response.
-            if args.format == 'human':
-              logging.warn('{}/{}: {}'.format(file_num, entry_num, api_error))
-            elif args.format == 'warc':
-              logging.warn('{}/{}: {}'.format(file_num, entry_num, api_error))
-              write_warcs(tweet_data, args.output, warcinfo_id)
-          first_tweet = False
-        if args.format == 'warc':
-          args.output.write('\r\n')
+          dedup_done = None
+        context = EntryContext(use_original, tweet['in_reply_to_id'], headers, entry,
+                               warcinfo_id, file_num, entry_num)
+        if pool:
+          # Different entries' fetches are independent, so overlap their network latency across
+          # threads. Output stays in input order: a conversation is only written once it reaches
+          # the head of the pending queue.
+          pending.append((pool.submit(fetch_conversation, tweet, api, use_original, remaining,
+                                      dedup_done, file_num, entry_num),
+                          context))
+          while len(pending) > args.threads * 2:
+            future, head_context = pending.popleft()
+            requests_made, rate_limit = finish_conversation(future.result(), head_context, api,
+                                                            args, rate_limit)
+            api_requests += requests_made
         else:
-          args.output.write('\n')
+          conversation = fetch_conversation(tweet, api, use_original, remaining, dedup_done,
+                                            file_num, entry_num)
+          requests_made, rate_limit = finish_conversation(conversation, context, api, args,
+                                                          rate_limit)
+          api_requests += requests_made
       if api_requests >= args.limit:
         logging.info('--limit exceeded: {} >= {}'.format(api_requests, args.limit))
         break
+    # Write out any of this file's conversations whose fetches were still in flight before
+    # moving on: the next file starts with its own warcinfo record, and these records have to
+    # come out ahead of it to stay in input order.
+    while pending:
+      future, context = pending.popleft()
+      requests_made, rate_limit = finish_conversation(future.result(), context, api, args,
+                                                      rate_limit)
+      api_requests += requests_made
     if api_requests >= args.limit:
+      payloads.close()
       break
+  if pool:
+    pool.shutdown()
+  args.output.flush()
   logging.info('Total: {}'.format(entry_num))
   logging.info('Empties: {}'.format(empties))
-  logging.info('Skipped: {}'.format(sum(done.values())))
+  logging.info('Skipped: {}'.format(sum(done.values()) - len(done)))
   logging.info('Twitter API requests: {}'.format(api_requests))
 
 
-def create_warcinfo(infile=None, outfile=None, ip=None, operator=None, description=None):
+def fetch_conversation(tweet, api, use_original, remaining, done, file_num, entry_num):
+  """Retrieve one entry's conversation. Pass done=None to disable dedup."""
+  try:
+    return get_conversation(tweet, api, use_original, remaining, done)
+  except AttributeError:
+    if done is not None:
+      logging.warn('%s/%s: %s', file_num, entry_num, tweet)
+    raise
+
+
+def finish_conversation(conversation, context, api, args, rate_limit):
+  """Log and write out one entry's fetched conversation.
+  Returns (requests_made, rate_limit): how many API requests the fetch made, and the updated
+  rate limit count."""
+  use_original = context.use_original
+  file_num = context.file_num
+  entry_num = context.entry_num
+  # Hoist the per-tweet invariants: the format never changes mid-conversation.
+  fmt_human = args.format == 'human'
+  fmt_warc = args.format == 'warc'
+  out_write = args.output.write
+  out_writelines = args.output.writelines
+  requests_made = len(conversation)
+  if use_original:
+    requests_made -= 1
+  # The rate limit summary is INFO-only, so skip the lookup and formatting entirely when INFO
+  # logging is off instead of paying for it once per entry.
+  if logging.getLogger().isEnabledFor(logging.INFO):
+    rate_limit = summarize_rate_limit_status(api, rate_limit, file_num, entry_num)
+  if context.in_reply_to_id:
+    logging.info('%s/%s: Reply tweet; retrieved %s in conversation chain.',
+                 file_num, entry_num, len(conversation))
+  elif len(conversation) == 0:
+    logging.warn('%s/%s: No tweets in conversation.', file_num, entry_num)
+  # Print out the conversation.
+  first_tweet = True
+  for tweet_data in conversation:
+    response = tweet_data['response']
+    api_error = get_api_error(response)
+    if use_original:
+      # We didn't need to re-retrieve the tweet. Just print the original.
+      if fmt_human:
+        out_write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num))
+      elif fmt_warc:
+        new_headers = warc_header_fix(context.headers, context.warcinfo_id, tweet_data)
+        out_writelines((new_headers, '\r\n', context.entry, '\r\n'))
+    elif response.status_code == 200:
+      if fmt_human:
+        out_write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num))
+      elif fmt_warc:
+        write_warcs(tweet_data, args.output, context.warcinfo_id)
+    elif first_tweet:
+      # It's the first tweet in the conversation, but it's truncated, and retrieval from
+      # the Twitter API failed. Use the original data from the input WARC instead.
+      if fmt_human:
+        out_write(tweet_tools.format_tweet_for_humans(tweet_data, file_num, entry_num))
+      elif fmt_warc:
+        logging.warn('%s/%s: %s on old tweet. Using original data instead.',
+                     file_num, entry_num, api_error)
+        new_headers = warc_header_fix(context.headers, context.warcinfo_id, tweet_data)
+        out_writelines((new_headers, '\r\n', context.entry, '\r\n'))
+    else:
+      # It's an earlier tweet in the conversation, but retrieval from the Twitter API
+      # failed. All we can do is print the error response.
+      if fmt_human:
+        logging.warn('%s/%s: %s', file_num, entry_num, api_error)
+      elif fmt_warc:
+        logging.warn('%s/%s: %s', file_num, entry_num, api_error)
+        write_warcs(tweet_data, args.output, context.warcinfo_id)
+    first_tweet = False
+  if fmt_warc:
+    out_write('\r\n')
+  else:
+    out_write('\n')
+  return requests_made, rate_limit
+
+
+def create_warcinfo(infile=None, outfile=None, ip=None, operator=None, description=None,
+                    git_commit=None):
   # Compile WARC headers.
   warc_headers_dict = {'WARC-Type':'warcinfo'}
   if outfile:
@@ -235,15 +369,10 @@ def create_warcinfo(infile=None, outfile=None, ip=None, operator=None, descripti
   }
   if infile:
     info_fields['modified-from'] = infile
-  git_commit = get_git_commit()
   if git_commit:
     info_fields['software'] += ' (commit {})'.format(git_commit)
   if ip:
     info_fields['ip'] = ip
-  else:
-    ip = run_command(['curl', '-s', 'https://icanhazip.com'], strip_newline=True)
-    if ip:
-      info_fields['ip'] = ip
   if operator:
     info_fields['operator'] = operator
   if description:
@@ -252,89 +381,159 @@ def create_warcinfo(infile=None, outfile=None, ip=None, operator=None, descripti
   return warc.WARCRecord(warc_headers, info_header_str)
 
 
-def warc_header_fix(headers, headers_dict=None, warcinfo_id=None, tweet_data=None):
+def uuid4_stream(batch=1024):
+  """Generate random UUID strings like str(uuid.uuid4()), but draw the randomness from
+  os.urandom in bulk and format the hex directly. uuid.uuid4() pays a separate urandom read,
+  UUID object construction and str() formatting per call, which adds up at one record id per
+  WARC record. The version/variant bits are set per RFC 4122, same as uuid4()."""
+  while True:
+    buf = os.urandom(16*batch)
+    for i in range(batch):
+      raw = bytearray(buf[i*16:(i+1)*16])
+      raw[6] = (raw[6] & 0x0f) | 0x40
+      raw[8] = (raw[8] & 0x3f) | 0x80
+      hex = binascii.hexlify(bytes(raw)).decode('ascii')
+      yield hex[0:8]+'-'+hex[8:12]+'-'+hex[12:16]+'-'+hex[16:20]+'-'+hex[20:32]
+
+_uuids = uuid4_stream()
+
+
+def warc_header_fix_empty(headers, warcinfo_id=None):
+  """warc_header_fix() for empty entries.
+  There's no tweet data to add headers for, so the membership checks can run on the raw header
+  block and no headers_to_dict() parse is needed."""
+  parts = [headers]
+  if warcinfo_id and 'WARC-Warcinfo-ID' not in headers:
+    parts.append('WARC-Warcinfo-ID: '+warcinfo_id+'\r\n')
+  if 'WARC-Record-ID' not in headers:
+    parts.append('WARC-Record-ID: <urn:uuid:{}>\r\n'.format(next(_uuids)))
+  return ''.join(parts)
+
+
+def warc_header_fix(headers, warcinfo_id=None, tweet_data=None):
   """Let's add some headers to one of the original WARCs.
-  Most importantly, they lack a WARC-Record-ID."""
-  if not headers_dict:
-    headers_dict = warc_simple.headers_to_dict(headers)
+  Most importantly, they lack a WARC-Record-ID.
+  The already-present checks scan the raw header block, like warc_header_fix_empty(): the
+  header names are distinctive enough that a substring hit means the header is there, and it
+  saves building a headers dict per entry just for two membership tests."""
+  # Collect the additions in a list and join once, instead of growing the headers string with
+  # repeated concatenation.
+  parts = [headers]
   if tweet_data and tweet_data.get('in_reply_to_id'):
-    headers += 'WARC-X-Tweet-Reply-To: '+tweet_tools.get_tweet_url(tweet_data, 'reply_to')+'\r\n'
+    parts.append('WARC-X-Tweet-Reply-To: '+tweet_tools.get_tweet_url(tweet_data, 'reply_to')+'\r\n')
   elif tweet_data and tweet_data['tweet'] and tweet_data['tweet'].get('in_reply_to_id'):
-    headers += 'WARC-X-Tweet-Reply-To: '+tweet_tools.get_tweet_url(tweet_data['tweet'], 'reply_to')+'\r\n'
+    parts.append('WARC-X-Tweet-Reply-To: '+tweet_tools.get_tweet_url(tweet_data['tweet'], 'reply_to')+'\r\n')
   if tweet_data and tweet_data.get('replied_by_id'):
-    headers += 'WARC-X-Tweet-Replied-By: '+tweet_tools.get_tweet_url(tweet_data, 'replied_by')+'\r\n'
+    parts.append('WARC-X-Tweet-Replied-By: '+tweet_tools.get_tweet_url(tweet_data, 'replied_by')+'\r\n')
   if tweet_data and tweet_data.get('retweeted_by_id'):
-    headers += 'WARC-X-Tweet-Retweeted-By: '+tweet_tools.get_tweet_url(tweet_data, 'retweeted_by')+'\r\n'
-  if warcinfo_id and 'WARC-Warcinfo-ID' not in headers_dict:
-    headers += 'WARC-Warcinfo-ID: '+warcinfo_id+'\r\n'
-  if 'WARC-Record-ID' not in headers_dict:
-    headers += 'WARC-Record-ID: <urn:uuid:{}>\r\n'.format(uuid.uuid4())
-  return headers
+    parts.append('WARC-X-Tweet-Retweeted-By: '+tweet_tools.get_tweet_url(tweet_data, 'retweeted_by')+'\r\n')
+  if warcinfo_id and 'WARC-Warcinfo-ID' not in headers:
+    parts.append('WARC-Warcinfo-ID: '+warcinfo_id+'\r\n')
+  if 'WARC-Record-ID' not in headers:
+    parts.append('WARC-Record-ID: <urn:uuid:{}>\r\n'.format(next(_uuids)))
+  return ''.join(parts)
 
 
 def write_warcs(tweet_data, destination=sys.stdout, warcinfo_id=None):
-  response_warc = make_response_warc(tweet_data, warcinfo_id)
+  # The warcinfo id and the three WARC-X-Tweet-* urls are the same for the request and response
+  # records, so build them once here and hand them to both.
+  shared_headers = tweet_warc_headers(tweet_data, warcinfo_id)
+  response_warc = make_response_warc(tweet_data, shared_headers)
   record_id = response_warc.header['WARC-Record-Id']
-  request_warc = make_request_warc(tweet_data, record_id, warcinfo_id)
+  request_warc = make_request_warc(tweet_data, record_id, shared_headers)
   request_warc.write_to(destination)
   response_warc.write_to(destination)
 
 
-def make_response_warc(tweet_data, warcinfo_id=None):
-  response = tweet_data['response']
-  warc_headers_dict = {'WARC-Type':'response',
-                       'WARC-Target-URI':response.request.url}
+def tweet_warc_headers(tweet_data, warcinfo_id=None):
+  """The WARC headers shared by a tweet's request and response records."""
+  headers = {}
   if warcinfo_id:
-    warc_headers_dict['WARC-Warcinfo-ID'] = warcinfo_id
+    headers['WARC-Warcinfo-ID'] = warcinfo_id
   if tweet_data.get('replied_by_id'):
-    warc_headers_dict['WARC-X-Tweet-Replied-By'] = tweet_tools.get_tweet_url(tweet_data, 'replied_by')
+    headers['WARC-X-Tweet-Replied-By'] = tweet_tools.get_tweet_url(tweet_data, 'replied_by')
   if tweet_data.get('in_reply_to_id'):
-    warc_headers_dict['WARC-X-Tweet-Reply-To'] = tweet_tools.get_tweet_url(tweet_data, 'reply_to')
+    headers['WARC-X-Tweet-Reply-To'] = tweet_tools.get_tweet_url(tweet_data, 'reply_to')
   if tweet_data.get('retweeted_by_id'):
-    warc_headers_dict['WARC-X-Tweet-Retweeted-By'] = tweet_tools.get_tweet_url(tweet_data, 'retweeted_by')
-  warc_headers = warc.WARCHeader(warc_headers_dict, defaults=True)
+    headers['WARC-X-Tweet-Retweeted-By'] = tweet_tools.get_tweet_url(tweet_data, 'retweeted_by')
+  return headers
 
-  response_headers = 'HTTP/1.1 {} {}\r\n'.format(response.status_code, response.reason)
-  for header, value in response.headers.items():
-    response_headers += '{}: {}\r\n'.format(header, value)
 
-  payload = response_headers+'\r\n'+response.content
+def make_response_warc(tweet_data, shared_headers):
+  response = tweet_data['response']
+  warc_headers_dict = {'WARC-Type':'response',
+                       'WARC-Target-URI':response.request.url}
+  warc_headers_dict.update(shared_headers)
+  warc_headers = warc.WARCHeader(warc_headers_dict, defaults=True)
+
+  # Prefer the headers as http.client recorded them: that keeps the original case, order,
+  # and any duplicate headers (e.g. repeated Set-Cookie), which the case-insensitive
+  # response.headers dict folds together -- better fidelity for an archival record, and no
+  # rebuilt dict to iterate. Not every transport exposes the original response, so fall back.
+  try:
+    header_items = response.raw._original_response.msg.items()
+  except AttributeError:
+    header_items = response.headers.items()
+  parts = ['HTTP/1.1 {} {}'.format(response.status_code, response.reason)]
+  for header, value in header_items:
+    parts.append('{}: {}'.format(header, value))
+  response_headers = '\r\n'.join(parts)+'\r\n'
+
+  # The output stream and every other warc-mode write are text, so the payload has to be str
+  # too -- decode the body (Twitter serves utf-8 JSON) rather than mixing bytes into the record.
+  payload = response_headers+'\r\n'+response.content.decode('utf-8')
   return warc.WARCRecord(warc_headers, payload)
 
 
-def make_request_warc(tweet_data, response_id, warcinfo_id=None):
+def make_request_warc(tweet_data, response_id, shared_headers):
   response = tweet_data['response']
   request = response.request
   warc_headers_dict = {'WARC-Type':'request',
                        'WARC-Concurrent-To':response_id,
                        'WARC-Target-URI':request.url}
-  if warcinfo_id:
-    warc_headers_dict['WARC-Warcinfo-ID'] = warcinfo_id
-  if tweet_data.get('replied_by_id'):
-    warc_headers_dict['WARC-X-Tweet-Replied-By'] = tweet_tools.get_tweet_url(tweet_data, 'replied_by')
-  if tweet_data.get('in_reply_to_id'):
-    warc_headers_dict['WARC-X-Tweet-Reply-To'] = tweet_tools.get_tweet_url(tweet_data, 'reply_to')
-  if tweet_data.get('retweeted_by_id'):
-    warc_headers_dict['WARC-X-Tweet-Retweeted-By'] = tweet_tools.get_tweet_url(tweet_data, 'retweeted_by')
+  warc_headers_dict.update(shared_headers)
   warc_headers = warc.WARCHeader(warc_headers_dict, defaults=True)
 
-  request_headers = '{} {} HTTP/1.1\r\n'.format(request.method, request.path_url)
-  request_headers += 'Host: {}\r\n'.format(urlparse.urlparse(request.url)[1])
+  # The Host header is usually already on the request; failing that, a simple regex match beats
+  # a full urlparse (which splits and validates every URL component just to get the netloc).
+  host = request.headers.get('Host')
+  if not host:
+    match = HOST_REGEX.match(request.url)
+    if match:
+      host = match.group(1)
+    else:
+      host = urlparse.urlparse(request.url)[1]
+  parts = ['{} {} HTTP/1.1'.format(request.method, request.path_url),
+           'Host: {}'.format(host)]
   for header, value in request.headers.items():
-    request_headers += '{}: {}\r\n'.format(header, value)
+    parts.append('{}: {}'.format(header, value))
+  request_headers = '\r\n'.join(parts)+'\r\n'
 
   return warc.WARCRecord(warc_headers, request_headers)
 
 
-def get_conversation(tweet, api, use_original=False, remaining=None, done=None):
+def int_id(id):
+  """Normalize a tweet id for the dedup dict.
+  Twitter ids are 64-bit numbers; keeping the keys as ints means a stray string id from the API
+  can't silently miss its duplicate (and ints are cheaper to hash than strings)."""
+  if id is None:
+    return None
+  return int(id)
+
+
+def get_conversation(tweet, api, use_original=False, remaining=None, done=None,
+                     response_cache=None):
   """Retrieve a tweet and all tweets before it in the conversation chain.
-  Supply the root tweet JSON and an authenticated retweever.Api object."""
+  Supply the root tweet JSON and an authenticated retweever.Api object.
+  response_cache is an optional {id: response} dict, e.g. filled by a bulk
+  api.GetStatuses() call; cached responses are used (and removed) instead of
+  issuing a GetStatus request, without counting against remaining."""
   conversation = []
   if done is None:
     done = {}
   # If use_original, use the first tweet as-is instead of fetching it again from the API.
   if use_original:
-    id = tweet['id']
+    id = int_id(tweet['id'])
     conversation.append({'id':id,
                          'tweet':tweet,
                          'response':None,
@@ -346,18 +545,22 @@ def get_conversation(tweet, api, use_original=False, remaining=None, done=None):
                          'retweeted_by_id':None,
                          'retweeted_by_user':None,
                         })
-    id = tweet.get('in_reply_to_id')
+    id = int_id(tweet.get('in_reply_to_id'))
   else:
-    id = tweet['id']
+    id = int_id(tweet['id'])
   replied_by_id = None
   replied_by_user = None
   retweeted_by_id = None
   retweeted_by_user = None
   while id:
     if id in done:
-      logging.info('Tweet {} already done. Skipping..'.format(id))
+      logging.info('Tweet %s already done. Skipping..', id)
+      with DONE_LOCK:
+        done[id] += 1
       break
-    if remaining is None or remaining > 0:
+    if response_cache and id in response_cache:
+      response = response_cache.pop(id)
+    elif remaining is None or remaining > 0:
       response = api.GetStatus(id)
       remaining -= 1
     else:
@@ -365,7 +568,8 @@ def get_conversation(tweet, api, use_original=False, remaining=None, done=None):
                    'requested.')
       break
     if response.status_code == 200:
-      done[id] = done.get(id, 0) + 1
+      with DONE_LOCK:
+        done[id] = done.get(id, 0) + 1
       try:
         tweet = tweet_tools.extract_tweet(response, datatype='request') or {}
       except ValueError:
@@ -402,7 +606,7 @@ def get_conversation(tweet, api, use_original=False, remaining=None, done=None):
       retweeted_by_user = None
     # The next tweet in the conversation could be one this replied to, or one it retweeted.
     # In this dataset, it's never both.
-    id = in_reply_to_id or retweeted_id
+    id = int_id(in_reply_to_id or retweeted_id)
   return conversation
 
 
@@ -411,7 +615,8 @@ def get_api_error(response):
     return ''
   status_code = str(response.status_code)
   try:
-    resp_json = response.json()
+    # Decode from the raw bytes instead of response.json() so orjson is used when available.
+    resp_json = tweet_tools.json_loads(response.content)
   except ValueError:
     return status_code
   error_strs = []
@@ -433,23 +638,43 @@ def summarize_rate_limit_status(api, last_remaining, file_num, entry_num):
   until_reset = limit.reset - now
   if limit.reset == 0:
     return limit.remaining
-  logging.info('{}/{}: {} requests remaining in next {:0.1f} minutes'
-               .format(file_num, entry_num, limit.remaining, until_reset/60))
+  logging.info('%s/%s: %s requests remaining in next %0.1f minutes',
+               file_num, entry_num, limit.remaining, until_reset/60)
   return limit.remaining
 
 
 def read_oauth_config(oauth_file, key_names):
-  config = ConfigParser.RawConfigParser()
-  config.read(oauth_file)
+  """Read the OAuth keys from a config file like oauth.cfg.sample.
+  The file is just "key = value" lines under an [auth] section, so parse it directly instead of
+  importing ConfigParser (which costs more to import than the whole parse)."""
   keys = {}
+  with open(oauth_file) as config:
+    for line in config:
+      line = line.strip()
+      if not line or line.startswith('#') or line.startswith(';') or line.startswith('['):
+        continue
+      key_name, delim, value = line.partition('=')
+      key_name = key_name.strip()
+      if delim and key_name in key_names:
+        keys[key_name] = value.strip()
   for key_name in key_names:
-    if config.has_option('auth', key_name):
-      keys[key_name] = config.get('auth', key_name)
-    else:
+    if key_name not in keys:
       fail('OAuth token "{}" not found in --oauth-file "{}".'.format(key_name, oauth_file))
   return keys
 
 
+def get_public_ip():
+  """Try to determine our public IP address, for the warcinfo record.
+  Returns None on any failure."""
+  try:
+    response = requests.get('https://icanhazip.com', timeout=5)
+  except requests.RequestException:
+    return None
+  if response.status_code == 200:
+    return response.text.strip()
+  return None
+
+
 def get_git_commit():
   """Get the current git commit of this script, for the warcinfo record."""
   script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -471,7 +696,7 @@ def get_git_commit():
 def run_command(command, strip_newline=False):
   devnull = open(os.devnull, 'w')
   try:
-    output = subprocess.check_output(command, stderr=devnull)
+    output = subprocess.check_output(command, stderr=devnull, universal_newlines=True)
     exit_status = 0
   except subprocess.CalledProcessError as cpe:
     output = cpe.output
@@ -491,9 +716,14 @@ def run_command(command, strip_newline=False):
 def tone_down_logger():
   """Change the logging level names from all-caps to capitalized lowercase.
   E.g. "WARNING" -> "Warning" (turn down the volume a bit in your log files)"""
+  # The level names are global to the logging module, so once is enough, even if several of
+  # these modules are imported and each calls its own copy of this function.
+  if getattr(tone_down_logger, '_done', False):
+    return
   for level in (logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG):
     level_name = logging.getLevelName(level)
     logging.addLevelName(level, level_name.capitalize())
+  tone_down_logger._done = True
 
 
 def fail(message):
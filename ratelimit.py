@@ -5,7 +5,15 @@ try:
 except ImportError:
     from urlparse import urlparse
 
-from twitter.twitter_utils import enf_type
+try:
+    from twitter.twitter_utils import enf_type
+except ImportError:
+    # python-twitter isn't installed; a plain-ValueError version is all set_limit() needs.
+    def enf_type(field, _type, val):
+        try:
+            return _type(val)
+        except ValueError:
+            raise ValueError('"{0}" must be type {1}'.format(field, _type.__name__))
 
 EndpointRateLimit = namedtuple('EndpointRateLimit',
                                ['limit', 'remaining', 'reset'])
@@ -2,19 +2,38 @@
 from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
+import re
 import sys
 import time
 import json
 import errno
 import logging
 import argparse
-from urllib import urlencode
-from urlparse import urlparse, urlunparse
+import threading
+try:
+  from urllib.parse import urlencode, urlparse, urlunparse
+except ImportError:
+  from urllib import urlencode
+  from urlparse import urlparse, urlunparse
 import requests
 from requests_oauthlib import OAuth1
 from ratelimit import RateLimit
+try:
+  import orjson
+  json_loads = orjson.loads
+except ImportError:
+  try:
+    import ujson
+    json_loads = ujson.loads
+  except ImportError:
+    json_loads = json.loads
 
 ARG_DEFAULTS = {'log':sys.stderr, 'volume':logging.ERROR}
+# The known failure pages Twitter serves instead of JSON, recognized in one pass over the
+# body instead of a separate substring scan per message.
+FAILWHALE_REGEX = re.compile(r'<title>Twitter / (Over capacity|Error)</title>|'
+                             r'Exceeded connection limit for user|'
+                             r'Error 401 Unauthorized')
 DESCRIPTION = """This is a pared-down modification of the python-twitter library that allows access
 to the raw HTTP headers and data returned from the API. Necessary for saving in WARC format.
 Only enough code to retrieve statuses is preserved."""
@@ -46,7 +65,7 @@ class Api(object):
                consumer_secret=None,
                access_token_key=None,
                access_token_secret=None,
-               timeout=None,
+               timeout=60,
                tweet_mode='extended',
                sleep_on_rate_limit=True):
     self.tweet_mode = tweet_mode
@@ -55,6 +74,19 @@ class Api(object):
     self.__auth = OAuth1(consumer_key, consumer_secret, access_token_key, access_token_secret)
     self.base_url = 'https://api.twitter.com/1.1'
     self.rate_limit = RateLimit()
+    # A pooled Session so TCP/TLS connections are reused across requests (and across threads,
+    # when the caller fetches concurrently).
+    self._session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    self._session.mount('https://', adapter)
+    self._rate_limit_lock = threading.Lock()
+    # GetStatus is nearly always called with its default flags, so precompute everything in
+    # that URL except the id, instead of re-running _BuildUrl/_EncodeParameters per call.
+    self._status_url_prefix = '%s/statuses/show.json?%s&id=' % (
+      self.base_url,
+      self._EncodeParameters({'trim_user': False, 'include_my_retweet': True,
+                              'include_entities': True, 'include_ext_alt_text': True,
+                              'tweet_mode': self.tweet_mode}))
 
   def GetStatus(self,
                 status_id,
@@ -86,29 +118,69 @@ class Api(object):
     """
     url = '%s/statuses/show.json' % (self.base_url)
 
+    if not trim_user and include_my_retweet and include_entities and include_ext_alt_text:
+      # All-defaults call: the query string is precomputed in __init__, only the id varies.
+      response = self._RequestUrl(url, full_url=self._status_url_prefix +
+                                  str(enf_type('status_id', int, status_id)))
+    else:
+      parameters = {
+        'id': enf_type('status_id', int, status_id),
+        'trim_user': enf_type('trim_user', bool, trim_user),
+        'include_my_retweet': enf_type('include_my_retweet', bool, include_my_retweet),
+        'include_entities': enf_type('include_entities', bool, include_entities),
+        'include_ext_alt_text': enf_type('include_ext_alt_text', bool, include_ext_alt_text)
+      }
+      response = self._RequestUrl(url, data=parameters)
+    if response:
+      self._ParseAndCheckTwitter(response.content)
+
+    return response
+
+
+  def GetStatuses(self,
+                  status_ids,
+                  trim_user=False,
+                  include_entities=True,
+                  include_ext_alt_text=True):
+    """Returns up to 100 status messages in a single request, via the statuses/lookup endpoint.
+    One lookup call costs the same rate-limit budget as one GetStatus call, so batching ids
+    through here turns up to 100 HTTP round-trips into one.
+    Args:
+      status_ids:
+        A sequence of up to 100 numeric status ids to retrieve.
+    Returns:
+      response:
+        The requests.models.Response object. The body is a JSON list of status objects; ids
+        that could not be retrieved are simply absent from it.
+    """
+    if len(status_ids) > 100:
+      raise TwitterError({'message': 'GetStatuses takes at most 100 ids per call.'})
+    url = '%s/statuses/lookup.json' % (self.base_url)
+
     parameters = {
-      'id': enf_type('status_id', int, status_id),
+      'id': ','.join(str(enf_type('status_id', int, status_id)) for status_id in status_ids),
       'trim_user': enf_type('trim_user', bool, trim_user),
-      'include_my_retweet': enf_type('include_my_retweet', bool, include_my_retweet),
       'include_entities': enf_type('include_entities', bool, include_entities),
       'include_ext_alt_text': enf_type('include_ext_alt_text', bool, include_ext_alt_text)
     }
 
     response = self._RequestUrl(url, data=parameters)
     if response:
-      data = response.content.decode('utf-8')
-      self._ParseAndCheckTwitter(data)
+      self._ParseAndCheckTwitter(response.content)
 
     return response
 
 
-  def _RequestUrl(self, url, data=None, json=None):
+  def _RequestUrl(self, url, data=None, json=None, full_url=None):
     """Request a url.
     Args:
       url:
         The web location we want to retrieve.
       data:
         A dict of (str, unicode) key/value pairs.
+      full_url:
+        The complete URL to fetch, query string included. When given, data is ignored and no
+        URL building happens; url is still used for the rate limit bookkeeping.
     Returns:
       The requests.models.Response object.
     """
@@ -116,19 +188,14 @@ class Api(object):
       raise TwitterError("The retweever.Api instance must be authenticated.")
 
     if url and self.sleep_on_rate_limit:
-      limit = self.CheckRateLimit(url)
-
-      if limit.remaining == 0:
-        try:
-          time.sleep(max(int(limit.reset - time.time()) + 2, 0))
-        except ValueError:
-          pass
-    if not data:
-      data = {}
+      self._WaitForRateLimit(url)
 
-    data['tweet_mode'] = self.tweet_mode
-    full_url = self._BuildUrl(url, extra_params=data)
-    resp = requests.get(full_url, auth=self.__auth, timeout=self._timeout)
+    if full_url is None:
+      if not data:
+        data = {}
+      data['tweet_mode'] = self.tweet_mode
+      full_url = self._BuildUrl(url, extra_params=data)
+    resp = self._session.get(full_url, auth=self.__auth, timeout=self._timeout)
 
     if full_url and resp and self.rate_limit:
       limit = resp.headers.get('x-rate-limit-limit', 0)
@@ -140,6 +207,25 @@ class Api(object):
     return resp
 
 
+  def _WaitForRateLimit(self, url):
+    """Gate a request on the endpoint's remaining rate-limit budget.
+    When the budget is spent, sleep until the reset; otherwise pre-charge one request against
+    the cached budget. Both happen under a lock, so with concurrent callers only one thread
+    sleeps while the rest queue behind it, instead of every in-flight request sleeping
+    independently and then all waking at once into a herd of 429s."""
+    with self._rate_limit_lock:
+      limit = self.CheckRateLimit(url)
+      if limit.remaining == 0:
+        try:
+          time.sleep(max(int(limit.reset - time.time()) + 2, 0))
+        except ValueError:
+          pass
+      else:
+        # Count this request against the budget before dispatch, so other threads see the
+        # in-flight request. The response headers overwrite this with authoritative numbers.
+        self.rate_limit.set_limit(url, limit.limit, limit.remaining - 1, limit.reset)
+
+
   def CheckRateLimit(self, url):
     """ Checks a URL to see the rate limit status for that endpoint.
     Args:
@@ -170,8 +256,7 @@ class Api(object):
     url = '%s/application/rate_limit_status.json' % self.base_url
 
     resp = self._RequestUrl(url)  # No-Cache
-    data = resp.content.decode('utf-8')
-    json_data = self._ParseAndCheckTwitter(data)
+    json_data = self._ParseAndCheckTwitter(resp.content)
 
     self.sleep_on_rate_limit = _sleep
     self.rate_limit = RateLimit(**json_data)
@@ -222,20 +307,27 @@ class Api(object):
 
   def _ParseAndCheckTwitter(self, raw_data):
     """Try and parse the JSON returned from Twitter.
+    Accepts the raw response bytes directly: every supported JSON parser takes bytes, so the
+    callers don't each pay a full utf-8 decode of the body just to parse it.
     This is a purely defensive check because during some Twitter
     network outages it will return an HTML failwhale page.
     """
     try:
-      json_data = json.loads(raw_data)
+      json_data = json_loads(raw_data)
     except ValueError:
-      if "<title>Twitter / Over capacity</title>" in raw_data:
-        raise TwitterError({'message': "Capacity Error"})
-      if "<title>Twitter / Error</title>" in raw_data:
-        raise TwitterError({'message': "Technical Error"})
-      if "Exceeded connection limit for user" in raw_data:
-        raise TwitterError({'message': "Exceeded connection limit for user"})
-      if "Error 401 Unauthorized" in raw_data:
-        raise TwitterError({'message': "Unauthorized"})
+      # Only the (rare) unparseable path needs a str to scan for the failure pages.
+      if isinstance(raw_data, bytes):
+        raw_data = raw_data.decode('utf-8', 'replace')
+      match = FAILWHALE_REGEX.search(raw_data)
+      if match:
+        if match.group(1) == 'Over capacity':
+          raise TwitterError({'message': "Capacity Error"})
+        elif match.group(1) == 'Error':
+          raise TwitterError({'message': "Technical Error"})
+        elif match.group(0) == 'Exceeded connection limit for user':
+          raise TwitterError({'message': "Exceeded connection limit for user"})
+        else:
+          raise TwitterError({'message': "Unauthorized"})
       raise TwitterError({'Unknown error: {0}'.format(raw_data)})
     self._CheckForTwitterError(json_data)
     return json_data
@@ -299,9 +391,14 @@ class TwitterError(Exception):
 def tone_down_logger():
   """Change the logging level names from all-caps to capitalized lowercase.
   E.g. "WARNING" -> "Warning" (turn down the volume a bit in your log files)"""
+  # The level names are global to the logging module, so once is enough, even if several of
+  # these modules are imported and each calls its own copy of this function.
+  if getattr(tone_down_logger, '_done', False):
+    return
   for level in (logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG):
     level_name = logging.getLevelName(level)
     logging.addLevelName(level, level_name.capitalize())
+  tone_down_logger._done = True
 
 
 def fail(message):
@@ -2,13 +2,34 @@
 from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
+import os
 import sys
 import json
 import errno
 import logging
 import argparse
+import operator
+import collections
 import requests
 import warc_simple
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+if orjson:
+  json_loads = orjson.loads
+else:
+  try:
+    import ujson
+    json_loads = ujson.loads
+  except ImportError:
+    json_loads = json.loads
+
+try:
+  string_types = basestring
+except NameError:
+  string_types = (str, bytes)
 
 
 ARG_DEFAULTS = {'columns':'WARC-Target-URI,user,id,text', 'log':sys.stderr, 'volume':logging.ERROR}
@@ -43,7 +64,15 @@ def main(argv):
   args = parser.parse_args(argv[1:])
 
   columns = args.columns.split(',')
-  outfmt = '{'+'}\t{'.join(columns)+'}'
+  # One itemgetter per column beats '{col}\t{col}'.format(**dict), which re-parses the
+  # template and unpacks the whole dict as kwargs on every tweet.
+  getters = [operator.itemgetter(column) for column in columns]
+  # If every requested column comes from the WARC headers (or is filename/tweet_num), the
+  # payloads never need to be JSON-parsed at all. --ignore-empties still needs the parse,
+  # since "empty" is defined by what's in the payload.
+  json_columns = [column for column in columns
+                  if not column.startswith('WARC-') and column not in ('filename', 'tweet_num')]
+  need_json = bool(json_columns) or args.ignore_empties
   warc_headers_dict = {}
   for column in columns:
     if column.startswith('WARC-'):
@@ -52,24 +81,67 @@ def main(argv):
   logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
   tone_down_logger()
 
+  # Same treatment stdout gets in crawl.py: at a terminal it's line-buffered, a syscall per
+  # tweet. Wrap a dup of the fd in a big buffer and write rows to that.
+  out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 8*1024*1024)
+  out_write = out.write
+
   tweet_num = 0
+  # One reusable row dict: resetting the requested WARC columns is cheaper than allocating a
+  # fresh dict and re-merging per tweet. Stale keys left over from a previous record are
+  # harmless, since only the requested columns are ever read out of it.
+  columns_dict = dict(warc_headers_dict)
+  warc_header_columns = tuple(warc_headers_dict)
   for warc_path in args.warcs:
-    for payload, headers in warc_simple.parse(warc_path, payload_json=True, header_dict=True):
+    for payload, headers in warc_simple.parse(warc_path, payload_json=need_json,
+                                              header_dict=True):
       tweet_num += 1
       if not payload and args.ignore_empties:
         continue
-      columns_dict = warc_headers_dict.copy()
+      for column in warc_header_columns:
+        columns_dict[column] = None
       columns_dict.update(headers)
-      columns_dict.update(extract_tweet(payload, datatype='json', empty_empties=False))
-      if columns_dict.get('text'):
-        columns_dict['text'] = columns_dict['text'].replace('\n', '\\n')
+      if need_json:
+        columns_dict.update(extract_tweet(payload, datatype='json', empty_empties=False))
+      text = columns_dict.get('text')
+      if text and '\n' in text:
+        # Most tweets have no newline; the membership test dodges the replace() allocation.
+        columns_dict['text'] = text.replace('\n', '\\n')
       columns_dict['filename'] = warc_path
       columns_dict['tweet_num'] = tweet_num
       try:
-        print(outfmt.format(**columns_dict))
+        out_write('\t'.join([str(getter(columns_dict)) for getter in getters])+'\n')
       except KeyError as ke:
         fail('Invalid column name "{}" given with --columns. Failed on tweet {}.'
-             .format(ke[0], tweet_num))
+             .format(ke.args[0], tweet_num))
+  out.flush()
+
+
+TweetFields = collections.namedtuple('TweetFields',
+                                     ('id', 'user', 'text', 'in_reply_to_id', 'in_reply_to_user'))
+
+
+def parse_entry(entry_raw):
+  """json.loads() a raw WARC payload, with the same error logging as extract_tweet()."""
+  try:
+    return json_loads(entry_raw)
+  except ValueError:
+    logging.critical('Content ({}): "{}.."'.format(type(entry_raw).__name__, entry_raw[:90]))
+    raise
+
+
+def extract_fields(entry):
+  """Cheap extractor for the few fields the main loops actually branch on.
+  Takes an already-parsed entry dict and returns a TweetFields namedtuple, or None for an empty
+  entry, without building the full dict that extract_tweet() does."""
+  status, user = get_user_and_status(entry)
+  if status is None and user is None:
+    return None
+  return TweetFields(id=status.get('id'),
+                     user=user.get('screen_name'),
+                     text=status.get('full_text') or status.get('text'),
+                     in_reply_to_id=status.get('in_reply_to_status_id'),
+                     in_reply_to_user=status.get('in_reply_to_screen_name'))
 
 
 def extract_tweet(entry_raw, datatype=None, empty_empties=True):
@@ -83,16 +155,27 @@ def extract_tweet(entry_raw, datatype=None, empty_empties=True):
     if 'user_mentions' in entry and 'id' in entry and 'screen_name' in entry:
       return entry
   elif datatype == 'request':
-    entry = entry_raw.json()
+    # Decode from the raw bytes instead of .json() so orjson/ujson is used when available.
+    entry = json_loads(entry_raw.content)
   elif datatype == 'json_str':
     try:
-      entry = json.loads(entry_raw)
+      entry = json_loads(entry_raw)
     except ValueError:
       logging.critical('Content ({}): "{}.."'.format(type(entry_raw).__name__, entry_raw[:90]))
       raise
   is_profile = 'status' in entry and 'screen_name' in entry
-  # Find the user and status objects in the entry.
-  status, user = get_user_and_status(entry)
+  # Find the user and status objects in the entry (get_user_and_status(), inlined here to
+  # save the call and tuple round-trip on this per-entry path).
+  if 'user' in entry:
+    # It's a status type of entry.
+    status = entry
+    user = entry['user']
+  elif 'status' in entry:
+    # It's a profile type of entry.
+    status = entry['status']
+    user = entry
+  else:
+    status = user = None
   if status is None and user is None:
     # It's a profile with no attached tweet (or something else).
     empty = True
@@ -102,32 +185,33 @@ def extract_tweet(entry_raw, datatype=None, empty_empties=True):
     user = {}
   else:
     empty = False
-  # Get and utf8-encode the status text.
-  if datatype == 'request':
-    text = status.get('full_text')
-    if text:
-      text = text.encode('utf-8')
-  elif 'full_text' in status:
-    text = status.get('full_text')
-  elif datatype == 'json_str':
-    text = status.get('text')
+  # Pre-bind the dict lookups the rest of the function hammers on (the same loop-locals
+  # pattern crawl.main uses): a LOAD_FAST per .get instead of a method lookup.
+  status_get = status.get
+  user_get = user.get
+  # Get the status text. The JSON parser already produced text strings; keep them that way
+  # and let the output layer encode once, instead of encoding here and making downstream
+  # code decode (or crash concatenating bytes to str) on the display path.
+  if 'full_text' in status:
+    text = status_get('full_text')
   else:
-    text = status.get('text')
-    if text:
-      text = text.encode('utf-8')
+    text = status_get('text')
   # If it's a retweet, get data about the original tweet.
-  retweeted_status = status.get('retweeted_status')
+  retweeted_status = status_get('retweeted_status')
   if retweeted_status:
     retweeted_id = retweeted_status.get('id')
     retweeted_text = retweeted_status.get('full_text') or retweeted_status.get('text')
-    if retweeted_text:
-      retweeted_text = retweeted_text.encode('utf-8')
   else:
     retweeted_id = None
     retweeted_text = None
   retweeted_user = None
-  # Get users @mentioned by the tweet.
-  mention_entities = status.get('entities', {}).get('user_mentions')
+  # Get users @mentioned by the tweet. The two-step get avoids allocating a throwaway {} on
+  # every entry with no entities (all profiles, for a start).
+  entities = status_get('entities')
+  if entities:
+    mention_entities = entities.get('user_mentions')
+  else:
+    mention_entities = None
   if mention_entities:
     user_mentions_list = []
     for entity in mention_entities:
@@ -138,34 +222,37 @@ def extract_tweet(entry_raw, datatype=None, empty_empties=True):
     user_mentions = ','.join(user_mentions_list)
   else:
     user_mentions = None
-  # Construct the return data structure.
-  tweet = {'empty':empty,
-           'id':status.get('id'),
-           'user':user.get('screen_name'),
-           'screen_name':user.get('screen_name'),
-           'description':user.get('description'),
-           'is_profile':is_profile,
-           'truncated':status.get('truncated'),
-           'in_reply_to_id':status.get('in_reply_to_status_id'),
-           'in_reply_to_user':status.get('in_reply_to_screen_name'),
-           'in_reply_to_status_id':status.get('in_reply_to_status_id'),
-           'in_reply_to_screen_name':status.get('in_reply_to_screen_name'),
-           'is_retweet':bool(retweeted_status),
-           'retweeted_id':retweeted_id,
-           'retweeted_text':retweeted_text,
-           'retweeted_user':retweeted_user,
-           'user_mentions':user_mentions,
-           'text':text}
+  # Profiles have no reply or retweet data; settle those fields before building the dict
+  # instead of building them and then overwriting eight keys with None.
   if is_profile:
-    tweet['in_reply_to_id'] = None
-    tweet['in_reply_to_user'] = None
-    tweet['in_reply_to_status_id'] = None
-    tweet['in_reply_to_screen_name'] = None
-    tweet['is_retweet'] = None
-    tweet['retweeted_id'] = None
-    tweet['retweeted_text'] = None
-    tweet['retweeted_user'] = None
-  return tweet
+    in_reply_to_id = None
+    in_reply_to_user = None
+    is_retweet = None
+    retweeted_id = None
+    retweeted_text = None
+    retweeted_user = None
+  else:
+    in_reply_to_id = status_get('in_reply_to_status_id')
+    in_reply_to_user = status_get('in_reply_to_screen_name')
+    is_retweet = bool(retweeted_status)
+  # Construct the return data structure.
+  return {'empty':empty,
+          'id':status_get('id'),
+          'user':user_get('screen_name'),
+          'screen_name':user_get('screen_name'),
+          'description':user_get('description'),
+          'is_profile':is_profile,
+          'truncated':status_get('truncated'),
+          'in_reply_to_id':in_reply_to_id,
+          'in_reply_to_user':in_reply_to_user,
+          'in_reply_to_status_id':in_reply_to_id,
+          'in_reply_to_screen_name':in_reply_to_user,
+          'is_retweet':is_retweet,
+          'retweeted_id':retweeted_id,
+          'retweeted_text':retweeted_text,
+          'retweeted_user':retweeted_user,
+          'user_mentions':user_mentions,
+          'text':text}
 
 
 def get_user_and_status(entry):
@@ -186,7 +273,7 @@ def format_tweet_for_humans(tweet_data, file_num, entry_num):
     if tweet['is_profile']:
       output += '{}/{}: Profile: @{}\n'.format(file_num, entry_num, tweet.get('user'))
       output += tweet.get('description')+'\n'
-      return output.encode('utf-8')
+      return output
     # Note: 'full_text' is needed instead of 'text' in order to get new-style tweets over 140
     # characters, including @mentions and links:
     # https://dev.twitter.com/overview/api/upcoming-changes-to-tweets
@@ -199,12 +286,7 @@ def format_tweet_for_humans(tweet_data, file_num, entry_num):
     except ValueError:
       logging.critical('{}/{}:'.format(file_num, entry_num))
       raise
-    try:
-      output += content+'\n'
-    except UnicodeDecodeError:
-      logging.error('{}/{}: content: {}'
-                    .format(file_num, entry_num, content))
-      raise
+    output += content+'\n'
     if tweet['in_reply_to_id']:
       output += 'A reply to: '+get_tweet_url(tweet, 'reply_to')+'\n'
     if tweet_data.get('replied_by_id'):
@@ -214,12 +296,14 @@ def format_tweet_for_humans(tweet_data, file_num, entry_num):
     output += 'Looks truncated? {}\n'.format(does_tweet_look_truncated(tweet))
   except KeyError as ke:
     logging.warn('{}/{}: Error in tweet data: JSON is missing key "{}".\n '
-                 'Tweet: {}..'.format(file_num, entry_num, ke[0], json.dumps(tweet))[:200])
+                 'Tweet: {}..'.format(file_num, entry_num, ke.args[0], json.dumps(tweet))[:200])
     raise
-  try:
-    return output.encode('utf-8')
-  except UnicodeDecodeError:
-    return output
+  return output
+
+
+# %-interpolation with a tuple skips the template re-parse and kwargs machinery that
+# str.format pays on every call, and this template runs several times per tweet.
+TWEET_URL_FORMAT = 'https://twitter.com/%s/status/%s'
 
 
 def get_tweet_url(tweet_data, urltype):
@@ -235,7 +319,7 @@ def get_tweet_url(tweet_data, urltype):
   elif urltype == 'retweeted_by':
     user = tweet_data['retweeted_by_user']
     id = tweet_data['retweeted_by_id']
-  return 'https://twitter.com/{}/status/{}'.format(user, id)
+  return TWEET_URL_FORMAT % (user, id)
 
 
 def does_tweet_look_truncated(tweet):
@@ -244,34 +328,49 @@ def does_tweet_look_truncated(tweet):
   # If 'full_text' is in there, that's using the new, extended mode. It's the whole thing.
   if 'full_text' in tweet:
     return False
-  try:
-    looks_truncated = u'\u2026' in tweet['text']
-  except UnicodeDecodeError:
-    looks_truncated = u'\u2026' in tweet['text'].decode('utf-8')
-  return looks_truncated
+  return u'\u2026' in tweet['text']
+
+
+# The concrete types detect_datatype sees, for one-probe dispatch instead of an isinstance
+# chain. Subclasses get resolved through the MRO on first sight and cached here.
+_DATATYPES = {dict:'json', requests.models.Response:'request'}
+if isinstance(string_types, tuple):
+  for _string_type in string_types:
+    _DATATYPES[_string_type] = 'json_str'
+else:
+  _DATATYPES[string_types] = 'json_str'
 
 
 def detect_datatype(raw_tweet):
-  if isinstance(raw_tweet, dict):
-    return 'json'
-  elif isinstance(raw_tweet, requests.models.Response):
-    return 'request'
-  elif isinstance(raw_tweet, basestring):
-    return 'json_str'
-  else:
-    raise ValueError('Object of unsupported type {}'.format(type(raw_tweet).__name__))
+  datatype = _DATATYPES.get(type(raw_tweet))
+  if datatype:
+    return datatype
+  for base in type(raw_tweet).__mro__:
+    datatype = _DATATYPES.get(base)
+    if datatype:
+      _DATATYPES[type(raw_tweet)] = datatype
+      return datatype
+  raise ValueError('Object of unsupported type {}'.format(type(raw_tweet).__name__))
 
 
 def json_pretty_format(jobj):
+  if orjson:
+    # orjson.dumps already returns utf-8 bytes.
+    return orjson.dumps(jobj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
   return json.dumps(jobj, sort_keys=True, indent=2, separators=(',', ': ')).encode('utf-8')
 
 
 def tone_down_logger():
   """Change the logging level names from all-caps to capitalized lowercase.
   E.g. "WARNING" -> "Warning" (turn down the volume a bit in your log files)"""
+  # The level names are global to the logging module, so once is enough, even if several of
+  # these modules are imported and each calls its own copy of this function.
+  if getattr(tone_down_logger, '_done', False):
+    return
   for level in (logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG):
     level_name = logging.getLevelName(level)
     logging.addLevelName(level, level_name.capitalize())
+  tone_down_logger._done = True
 
 
 def fail(message):
@@ -14,8 +14,28 @@ import errno
 import logging
 import argparse
 import collections
+try:
+  import orjson
+  json_loads = orjson.loads
+except ImportError:
+  try:
+    import ujson
+    json_loads = ujson.loads
+  except ImportError:
+    json_loads = json.loads
 
 HTTP_METHODS = ('get', 'post', 'head', 'put', 'delete', 'trace', 'options', 'connect', 'patch')
+# WARC files are read strictly front to back, so a large buffer cuts the read syscalls way down.
+READ_BUFFER_SIZE = 1024*1024
+# The version lines seen in practice. Anything else still works via the float() probe, but a plain
+# tuple membership check is much cheaper than setting up a try/except for every candidate line.
+WARC_VERSION_LINES = ('WARC/1.0\n', 'WARC/1.0\r\n', 'WARC/1.1\n', 'WARC/1.1\r\n')
+# Plain dicts keep insertion order as of Python 3.7, without OrderedDict's extra bookkeeping
+# per insert. Older interpreters still need the real thing to keep headers in file order.
+if sys.version_info >= (3, 7):
+  _HeaderDict = dict
+else:
+  _HeaderDict = collections.OrderedDict
 ARG_DEFAULTS = {'log':sys.stderr, 'volume':logging.ERROR}
 DESCRIPTION = """This is a simplified parser for WARC-like files.
 When run as a script, it will prints all WARC records as a list of JSON objects.
@@ -64,27 +84,33 @@ def main(argv):
   logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
   tone_down_logger()
 
+  # Hoist the per-record argument lookups out of the loop; they don't change between records.
+  one_object = args.one_object
+  payload_json = args.json
+  prettify = args.prettify
+  out_write = sys.stdout.write
+  if args.tweets:
+    payloads_key = 'tweets'
+  else:
+    payloads_key = 'payloads'
+
   records = []
   for path in args.warcs:
-    for record in parse(path, payload_json=args.json, omit_headers=True):
-      if args.one_object:
-        if args.tweets:
-          payloads_key = 'tweets'
-        else:
-          payloads_key = 'payloads'
+    for record in parse(path, payload_json=payload_json, omit_headers=True):
+      if one_object:
         records.append({'path':path, payloads_key:record})
-      elif args.json:
-        if args.prettify:
-          json.dump(record, sys.stdout, sort_keys=True, indent=2, separators=(',', ': '))
+      elif payload_json:
+        # One write per record instead of a json.dump plus a print (json.dump makes many small
+        # writes to the stream; dumps builds the string in one go).
+        if prettify:
+          out_write(json.dumps(record, sort_keys=True, indent=2, separators=(',', ': '))+'\n\n')
         else:
-          json.dump(record, sys.stdout)
-        print('\n')
+          out_write(json.dumps(record)+'\n\n')
       else:
-        print(record)
-        print()
+        out_write(record+'\n\n')
 
-  if args.one_object:
-    if args.prettify:
+  if one_object:
+    if prettify:
       json.dump(records, sys.stdout, sort_keys=True, indent=2, separators=(',', ': '))
     else:
       json.dump(records, sys.stdout)
@@ -103,11 +129,13 @@ def parse(warc_path, payload_json=False, header_dict=False, omit_headers=False):
   for payload, headers in parse_warc.parse_warc('path/to/filename.warc'):
     print payload
   """
-  headers = ''
-  content = ''
+  # Accumulate each record's lines in a list and join once per record: growing a str with +=
+  # re-copies everything written so far, which goes quadratic on big payloads.
+  headers = []
+  content = []
   warc_type = None
   header = False
-  with open(warc_path, 'rU') as warc:
+  with open(warc_path, 'r', READ_BUFFER_SIZE) as warc:
     for line in warc:
       if header:
         if not line.rstrip('\r\n'):
@@ -115,29 +143,71 @@ def parse(warc_path, payload_json=False, header_dict=False, omit_headers=False):
           header = False
         else:
           if line.startswith('WARC-Type:'):
-            fields = line.split(':')
-            if len(fields) == 2:
-              warc_type = fields[1].strip().lower()
-          headers += line
+            warc_type = line.partition(':')[2].strip().lower()
+          headers.append(line)
       else:
         if line.startswith('WARC/'):
           # Does the line look like the start of a WARC header? ("WARC/1.0")
-          try:
-            float(line[5:].rstrip('\r\n'))
+          if line in WARC_VERSION_LINES:
             header = True
-          except ValueError:
-            pass
+          else:
+            try:
+              float(line[5:].rstrip('\r\n'))
+              header = True
+            except ValueError:
+              pass
         if header:
           # We're starting a new record. Output the previous record, if any, and reset.
           if content:
-            yield create_return_data(content, headers, warc_type, payload_json, omit_headers, header_dict)
+            yield create_return_data(''.join(content), ''.join(headers), warc_type, payload_json,
+                                     omit_headers, header_dict)
           warc_type = None
-          headers = line
-          content = ''
+          headers = [line]
+          content = []
+        else:
+          content.append(line)
+    if content:
+      yield create_return_data(''.join(content), ''.join(headers), warc_type, payload_json,
+                               omit_headers, header_dict)
+
+
+def iter_payloads(warc_path):
+  """Fast-path version of parse() for callers that decode payloads themselves.
+  Yields (headers, payload) for each WARC record, both as single raw strings, skipping the JSON
+  and header-dict processing that parse() does. Records are accumulated in lists and joined once
+  per record, so the per-record cost is basically just the file read."""
+  headers = []
+  content = []
+  header = False
+  with open(warc_path, 'r', READ_BUFFER_SIZE) as warc:
+    for line in warc:
+      if header:
+        if not line.rstrip('\r\n'):
+          # The header ends at the first blank line.
+          header = False
+        else:
+          headers.append(line)
+      else:
+        if line.startswith('WARC/'):
+          # Does the line look like the start of a WARC header? ("WARC/1.0")
+          if line in WARC_VERSION_LINES:
+            header = True
+          else:
+            try:
+              float(line[5:].rstrip('\r\n'))
+              header = True
+            except ValueError:
+              pass
+        if header:
+          # We're starting a new record. Output the previous record, if any, and reset.
+          if content:
+            yield ''.join(headers), ''.join(content)
+          headers = [line]
+          content = []
         else:
-          content += line
+          content.append(line)
     if content:
-      yield create_return_data(content, headers, warc_type, payload_json, omit_headers, header_dict)
+      yield ''.join(headers), ''.join(content)
 
 
 def create_return_data(content, headers, warc_type, payload_json, omit_headers, header_dict):
@@ -146,7 +216,7 @@ def create_return_data(content, headers, warc_type, payload_json, omit_headers,
       content = strip_http_headers(content, warc_type)
     if content and warc_type in ('request', 'response', 'conversion'):
       try:
-        payload = json.loads(content)
+        payload = json_loads(content)
       except ValueError:
         logging.critical('Payload: "{}"'.format(content[:130]))
         raise
@@ -165,21 +235,23 @@ def create_return_data(content, headers, warc_type, payload_json, omit_headers,
 
 
 def headers_to_dict(headers):
-  header_dict = collections.OrderedDict()
+  header_dict = _HeaderDict()
   for header_line in headers.splitlines():
-    fields = header_line.split(':')
-    if header_line.startswith('WARC/') and len(fields) == 1:
+    # partition() splits on the first colon only, so values containing colons (like urls) don't
+    # get chopped up and re-joined.
+    header, sep, value = header_line.partition(':')
+    if not sep and header_line.startswith('WARC/'):
       header_dict['__VERSION__'] = header_line
       continue
-    assert len(fields) >= 2, header_line
-    header = fields[0]
-    value = ':'.join(fields[1:]).lstrip(' ')
-    header_dict[header] = value
+    assert sep, header_line
+    header_dict[header] = value.lstrip(' ')
   return header_dict
 
 
 def strip_http_headers(payload, warc_type):
-  new_payload = ''
+  # Collect the content lines and join once at the end; += on a str re-copies the whole payload
+  # for every line appended.
+  new_payload = []
   first_line = True
   in_http_header = False
   for line in payload.splitlines():
@@ -195,22 +267,24 @@ def strip_http_headers(payload, warc_type):
       if not line.rstrip('\r\n'):
         in_http_header = False
     else:
-      new_payload += line
-  return new_payload
+      new_payload.append(line)
+  return ''.join(new_payload)
 
 
 def looks_like_http_header(line, warc_type):
   """Does this look like the first line of an HTTP request or response?"""
-  fields = line.lower().split()
+  # Split only the fields we look at and lowercase just those, instead of copying the whole line
+  # (the request line includes the URL, which can be long).
+  fields = line.split(None, 3)
   if warc_type == 'request':
     if len(fields) >= 3:
-      method = fields[0]
-      protocol = fields[2]
+      method = fields[0].lower()
+      protocol = fields[2].lower()
       if method in HTTP_METHODS and protocol.startswith('http/'):
         return True
   elif warc_type == 'response':
     if len(fields) >= 2:
-      protocol = fields[0]
+      protocol = fields[0].lower()
       status = fields[1]
       try:
         int(status)
@@ -225,9 +299,14 @@ def looks_like_http_header(line, warc_type):
 def tone_down_logger():
   """Change the logging level names from all-caps to capitalized lowercase.
   E.g. "WARNING" -> "Warning" (turn down the volume a bit in your log files)"""
+  # The level names are global to the logging module, so once is enough, even if several of
+  # these modules are imported and each calls its own copy of this function.
+  if getattr(tone_down_logger, '_done', False):
+    return
   for level in (logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG):
     level_name = logging.getLevelName(level)
     logging.addLevelName(level, level_name.capitalize())
+  tone_down_logger._done = True
 
 
 if __name__ == '__main__':